@@ -6,11 +6,14 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import itertools
+from time import sleep
 from datetime import datetime, timedelta, date, time
-import holidays
-from PIL import Image
+import ijson
 
 # ======================================
 # 🔐 CONFIGURATION
@@ -19,20 +22,47 @@ LOOKER_BASE_URL = "https://weinfuse.cloud.looker.com/api/4.0"
 CLIENT_ID = st.secrets.get("LOOKER_CLIENT_ID", "43JnKGJSRJSmd42CfP6B")
 CLIENT_SECRET = st.secrets.get("LOOKER_CLIENT_SECRET", "X4JRgWYxsbrY7cstW34dRjnD")
 LOOK_ID = 8792
+LOOKER_TIMEOUT = (10, 30)  # (connect, read) seconds
+LOOKER_QUERY_TIMEOUT = (10, 300)  # query runs may spend minutes in the warehouse before the first byte
+LOOKER_ATTEMPTS = 3  # per call, with exponential backoff on 5xx / failed connections
 CLINIC_HOURS = 9  # 8 AM–5 PM
 MINUTES_PER_HOUR = 60
 CLINIC_START = time(8, 0)
 CLINIC_END = time(17, 0)
+# "08:00 AM" ... "05:00 PM", indexed by whole minutes after opening
+CLINIC_TIME_LABELS = np.array([
+    (datetime.combine(date.min, CLINIC_START) + timedelta(minutes=m)).strftime("%I:%M %p")
+    for m in range(CLINIC_HOURS * MINUTES_PER_HOUR + 1)
+])
 OPTIMIZATION_WINDOW_DAYS = 30  # rolling window
-us_holidays = holidays.US()
+APPOINTMENT_FIELDS = [
+    "appointments.status",
+    "appointments.start_time",
+    "appointments.end_time",
+    "locations.name",
+    "appointments.chair_id",
+    "administration_details.med_name",
+]
+# Parts of the Look's saved query that change which rows come back or how times are rendered;
+# fields, sorts, pivots, limit and vis settings are replaced or irrelevant for an inline run
+LOOK_QUERY_KEYS = ["model", "view", "filters", "filter_expression", "query_timezone", "dynamic_fields"]
+UTC_OFFSET_SUFFIX = r"(?:Z|[+-]\d{2}:?\d{2})$"  # "Z", "-05:00" or "-0500" after the time
+CATEGORICAL_FIELDS = ["locations.name", "appointments.status", "appointments.chair_id", "administration_details.med_name"]
+
+def optimization_window():
+    """First and last day considered: tomorrow through the next 30 days."""
+    first_day = date.today() + timedelta(days=1)
+    return first_day, first_day + timedelta(days=OPTIMIZATION_WINDOW_DAYS)
 
 # ======================================
 # 🖼️ LOGO
 # ======================================
+st.set_page_config(page_title="Vivo Appointment Optimizer", layout="centered")
+
 LOGO_PATH = "Vivo.png"
 try:
-    logo = Image.open(LOGO_PATH)
-    st.image(logo, width=180)
+    # Streamlit serves the file by path, so the PNG is never decoded with PIL here
+    st.image(LOGO_PATH, width=180)
 except Exception as e:
     st.warning(f"⚠️ Unable to load logo from {LOGO_PATH}: {e}")
 
@@ -46,48 +76,148 @@ st.write(
 # ======================================
 # 🔌 LOOKER API
 # ======================================
+@st.cache_resource(show_spinner=False)
+def looker_session():
+    """Keep-alive HTTP session shared by every Looker call."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+@st.cache_resource(ttl=3000, show_spinner=False)
 def get_looker_token():
+    """Log in to Looker; the token is shared by all sessions until shortly before it expires."""
     url = f"{LOOKER_BASE_URL}/login"
     payload = {"client_id": CLIENT_ID, "client_secret": CLIENT_SECRET}
-    r = requests.post(url, data=payload)
+    r = looker_session().post(url, data=payload, timeout=LOOKER_TIMEOUT)
     r.raise_for_status()
     return r.json()["access_token"]
 
+def looker_request(method, url, **kwargs):
+    """Call a Looker endpoint, logging in again once on 401 and backing off on transient failures."""
+    kwargs.setdefault("timeout", LOOKER_TIMEOUT)
+    relogged = False
+    attempt = 0
+    while True:
+        try:
+            r = looker_session().request(
+                method, url, headers={"Authorization": f"token {get_looker_token()}"}, **kwargs
+            )
+        except requests.ConnectionError:
+            # Covers ConnectTimeout; a ReadTimeout is not retried, since the query may still be running in Looker
+            if attempt == LOOKER_ATTEMPTS - 1:
+                raise
+        else:
+            if r.status_code == 401 and not relogged:
+                r.close()
+                get_looker_token.clear()
+                relogged = True
+                continue
+            if r.status_code < 500 or attempt == LOOKER_ATTEMPTS - 1:
+                if not r.ok:
+                    r.close()
+                r.raise_for_status()
+                return r
+            r.close()
+        sleep(0.5 * 2 ** attempt)
+        attempt += 1
+
+def looker_filter_literal(value):
+    """Escape Looker filter-expression characters so a value matches literally."""
+    return "".join(f"^{c}" if c in '^,%_"' else c for c in value)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_look_query():
+    """The Look's saved query (model, view, filters, custom filter, timezone), for running it inline with extra filters."""
+    r = looker_request("GET", f"{LOOKER_BASE_URL}/looks/{LOOK_ID}?fields=query")
+    query = r.json()["query"]
+    look_query = {key: query[key] for key in LOOK_QUERY_KEYS if query.get(key) is not None}
+    look_query["filters"] = query.get("filters") or {}
+    return look_query
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_locations_list():
-    token = get_looker_token()
-    headers = {"Authorization": f"token {token}"}
-    url = f"{LOOKER_BASE_URL}/looks/{LOOK_ID}/run/json?fields=locations.name&limit=-1"
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    df = pd.DataFrame(r.json())
-    return sorted(df["locations.name"].dropna().unique())
+    # run_look cannot project fields, so run the Look's query inline with just the name: Looker
+    # groups by it and returns one row per location instead of the whole Look
+    body = {**get_look_query(), "fields": ["locations.name"], "limit": "-1"}
+    # Pull just the name values out of the stream; no per-row dicts are built
+    with looker_request(
+        "POST", f"{LOOKER_BASE_URL}/queries/run/json", json=body, stream=True, timeout=LOOKER_QUERY_TIMEOUT
+    ) as r:
+        r.raw.decode_content = True
+        names = {name for name in ijson.items(r.raw, "item.locations.name") if name}
+    return sorted(names)
 
 def get_appointment_data(location_name):
-    token = get_looker_token()
-    headers = {"Authorization": f"token {token}"}
-    url = f"{LOOKER_BASE_URL}/looks/{LOOK_ID}/run/json?limit=-1&filter=locations.name:{location_name}"
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    df = pd.DataFrame(r.json())
-    st.success(f"✅ Retrieved {len(df)} appointment records for {location_name}.")
-    return df
+    # run_look ignores filters, so run the Look's query inline with the location filter applied server-side
+    # Status and date window are pushed down too, so past and cancelled rows never leave Looker
+    query = get_look_query()
+    today, cutoff = optimization_window()
+    filters = dict(query["filters"])
+    # Only fill status/date when the Look leaves them open, so its own filter is never widened;
+    # preprocess still narrows the rows to Complete/Active within the window either way
+    if not filters.get("appointments.status"):
+        filters["appointments.status"] = "Complete,Active"
+    if not filters.get("appointments.start_time"):
+        filters["appointments.start_time"] = f"{today:%Y/%m/%d} to {cutoff + timedelta(days=1):%Y/%m/%d}"
+    filters["locations.name"] = looker_filter_literal(location_name)
+    body = {**query, "fields": APPOINTMENT_FIELDS, "filters": filters, "limit": "-1"}
+    # Stream the JSON array row by row instead of holding the whole payload as dicts;
+    # the with-block hands the pooled connection back even if parsing fails midway
+    with looker_request(
+        "POST", f"{LOOKER_BASE_URL}/queries/run/json", json=body, stream=True, timeout=LOOKER_QUERY_TIMEOUT
+    ) as r:
+        r.raw.decode_content = True
+        rows = ijson.items(r.raw, "item", use_float=True)
+        first = next(rows, None)
+        if first is not None:
+            missing = [field for field in APPOINTMENT_FIELDS if field not in first]
+            if missing:
+                raise KeyError(f"Look {LOOK_ID} no longer returns required fields: {', '.join(missing)}")
+            rows = itertools.chain([first], rows)
+        records = (tuple(row[field] for field in APPOINTMENT_FIELDS) for row in rows)
+        df = pd.DataFrame.from_records(records, columns=APPOINTMENT_FIELDS)
+        return df.astype({col: "category" for col in CATEGORICAL_FIELDS})
 
 # ======================================
 # 🧮 DATA PREPARATION + CAPACITY
 # ======================================
+@st.cache_resource(show_spinner=False)
+def load_us_holidays():
+    """One holidays.US() per process, so years it has already expanded survive reruns."""
+    import holidays  # deferred: only needed once a schedule is loaded
+
+    return holidays.US()
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def holiday_dates(start, end):
+    """US holidays from start through end as a datetime64[D] array."""
+    return np.array(load_us_holidays()[start:end + timedelta(days=1)], dtype="datetime64[D]")
+
+def parse_wall_clock(values):
+    """Parse ISO timestamps as the clinic's local wall-clock time, dropping any trailing UTC offset.
+
+    The offset changes across DST inside the window (-04:00 / -05:00), and pandas refuses mixed offsets.
+    """
+    return pd.to_datetime(values.str.replace(UTC_OFFSET_SUFFIX, "", regex=True), format="ISO8601")
+
 def preprocess(df):
     """Filter appointments to tomorrow through the next 30 days."""
-    df = df[df["appointments.status"].isin(["Complete", "Active"])].copy()
-    df["appointments.start_time"] = pd.to_datetime(df["appointments.start_time"])
-    df["appointments.end_time"] = pd.to_datetime(df["appointments.end_time"])
-    df["appointments.created_date"] = pd.to_datetime(df["appointments.created_date"]).dt.date
-    df["Original_Date"] = df["appointments.start_time"].dt.date
-    df["Duration"] = (df["appointments.end_time"] - df["appointments.start_time"]).dt.total_seconds() / 60
-
-    today = date.today() + timedelta(days=1)
-    cutoff = today + timedelta(days=OPTIMIZATION_WINDOW_DAYS)
-    df = df[(df["Original_Date"] >= today) & (df["Original_Date"] <= cutoff)]
-    df = df[~df["Original_Date"].isin(us_holidays)]
+    start = parse_wall_clock(df["appointments.start_time"])
+    end = parse_wall_clock(df["appointments.end_time"])
+    original_date = start.dt.normalize()
+
+    today, cutoff = optimization_window()
+    keep = (
+        df["appointments.status"].isin(["Complete", "Active"])
+        & end.notna()
+        & (original_date >= pd.Timestamp(today))
+        & (original_date <= pd.Timestamp(cutoff))
+        & ~np.isin(original_date.to_numpy().astype("datetime64[D]"), holiday_dates(today, cutoff))
+    )
+    df = df.loc[keep].assign(
+        Original_Date=original_date[keep],
+        Duration=((end[keep] - start[keep]) // pd.Timedelta(minutes=1)).astype("int32"),
+    )
     df["Appt_ID"] = df.index
 
     return df[
@@ -95,64 +225,73 @@ def preprocess(df):
     ].dropna()
 
 def calculate_utilization_by_chair(df):
-    """Calculate utilization per chair per day (540 minutes max each)."""
+    """Calculate utilization per chair per day (540 minutes max each), indexed by location, date and chair."""
     util = (
-        df.groupby(["locations.name", "appointments.chair_id", "Original_Date"])
-        .agg(Total_Minutes=("Duration", "sum"))
+        df.groupby(["locations.name", "appointments.chair_id", "Original_Date"], sort=False, observed=True)["Duration"]
+        .sum()
+        .rename("Total_Minutes")
         .reset_index()
     )
-    util["Available_Minutes"] = CLINIC_HOURS * 60  # 540 minutes per chair
-    util["Remaining_Minutes"] = util["Available_Minutes"] - util["Total_Minutes"]
-    util["Remaining_Minutes"] = util["Remaining_Minutes"].clip(lower=0)
-    return util
+    chair_minutes = CLINIC_HOURS * MINUTES_PER_HOUR  # 540 minutes per chair
+    util["Remaining_Minutes"] = np.maximum(chair_minutes - util["Total_Minutes"].to_numpy(), 0)
+    # Sorted (location, date, chair) index lets the optimizer slice instead of scanning with masks
+    return util.set_index(["locations.name", "Original_Date", "appointments.chair_id"]).sort_index()
+
+@st.cache_data(ttl=900, show_spinner=False)
+def get_chair_utilization(location_name, day):
+    """Chair/day utilization plus raw record count; `day` keys the cache so the window rolls over daily."""
+    df_raw = get_appointment_data(location_name)
+    return calculate_utilization_by_chair(preprocess(df_raw)), len(df_raw)
 
 # ======================================
 # 🧠 OPTIMIZATION — FIND 3 BEST CHAIRS/DAYS
 # ======================================
-def find_top3_optimal_chairs(df, location, duration):
+def find_top3_optimal_chairs(util, location, duration):
     """Find next 3 most optimal chair/day combos."""
-    util = calculate_utilization_by_chair(df)
-    today = datetime.now().date() + timedelta(days=1)
-    cutoff = today + timedelta(days=OPTIMIZATION_WINDOW_DAYS)
-
-    loc_util = util[
-        (util["locations.name"] == location)
-        & (util["Original_Date"] >= today)
-        & (util["Original_Date"] <= cutoff)
-    ].copy()
-    loc_util = loc_util[~loc_util["Original_Date"].isin(us_holidays)]
-    loc_util = loc_util[loc_util["Remaining_Minutes"] >= duration]
+    today, cutoff = optimization_window()
+
+    try:
+        loc_util = util.loc[location].loc[pd.Timestamp(today):pd.Timestamp(cutoff)]
+    except KeyError:
+        loc_util = util.iloc[:0].droplevel("locations.name")
+    loc_util = loc_util[loc_util["Remaining_Minutes"] >= duration].reset_index()
 
     if loc_util.empty:
         st.warning(f"No available chair capacity for {location} within next 30 days.")
         return pd.DataFrame()
 
-    # Calculate next available start time for each chair/day
-    total_day_minutes = CLINIC_HOURS * 60
-    loc_util["Utilization_Ratio"] = loc_util["Total_Minutes"] / loc_util["Available_Minutes"]
-    loc_util["Next_Start_Minute"] = loc_util["Utilization_Ratio"] * total_day_minutes
-
-    def compute_next_available(row):
-        next_time = datetime.combine(row["Original_Date"], CLINIC_START) + timedelta(minutes=row["Next_Start_Minute"])
-        if next_time.time() > CLINIC_END:
-            next_time = datetime.combine(row["Original_Date"], CLINIC_END)
-        return next_time.strftime("%I:%M %p")
+    # Earliest day, then most free minutes (fewest booked); rows arrive in chair order, so
+    # keep="first" still breaks ties by the lowest chair
+    top3 = loc_util.nsmallest(3, ["Original_Date", "Total_Minutes"])
 
-    loc_util["Next_Available_Time"] = loc_util.apply(compute_next_available, axis=1)
-
-    loc_util = loc_util.sort_values(by=["Original_Date", "Remaining_Minutes"], ascending=[True, False])
-    return loc_util.head(3)[
-        ["Original_Date", "appointments.chair_id", "Next_Available_Time", "Remaining_Minutes"]
-    ]
+    # Booked minutes are packed from opening time, so the next start is offset by Total_Minutes
+    next_minute = np.clip(top3["Total_Minutes"].to_numpy(), 0, CLINIC_HOURS * MINUTES_PER_HOUR)
+    return pd.DataFrame({
+        "Original_Date": top3["Original_Date"].dt.date,
+        "appointments.chair_id": top3["appointments.chair_id"],
+        "Next_Available_Time": CLINIC_TIME_LABELS[next_minute.astype(int)],
+        "Remaining_Minutes": top3["Remaining_Minutes"],
+    })
 
 # ======================================
 # 🖥️ STREAMLIT INTERFACE
 # ======================================
-st.set_page_config(page_title="Vivo Appointment Optimizer", layout="centered")
+@st.fragment
+def optimizer_panel(location):
+    """Duration input and results; reruns on its own when the duration changes."""
+    util = st.session_state["util"]
+    duration = st.number_input("Appointment Duration (minutes)", min_value=1, max_value=540, value=60)
+
+    if st.button("📅 Show Top 3 Optimal Chair/Days"):
+        results = find_top3_optimal_chairs(util, location, duration)
+        if not results.empty:
+            st.subheader(f"Next 3 Optimal Chair Appointment Days — {location} (Starting Tomorrow)")
+            st.dataframe(results, use_container_width=True)
 
 if "locations" not in st.session_state:
     with st.spinner("Loading available locations from Looker..."):
         try:
+            # Also caches the Look's query definition, so the first schedule load skips that round trip
             st.session_state["locations"] = get_locations_list()
         except Exception as e:
             st.error(f"Error retrieving locations: {e}")
@@ -162,20 +301,14 @@ if "locations" in st.session_state:
     if st.button("🔄 Load Schedule for Selected Location"):
         with st.spinner(f"Fetching data for {location}..."):
             try:
-                df_raw = get_appointment_data(location)
-                st.session_state["data"] = preprocess(df_raw)
+                util, n_records = get_chair_utilization(location, date.today())
+                st.success(f"✅ Retrieved {n_records} appointment records for {location}.")
+                st.session_state["util"] = util
             except Exception as e:
                 st.error(f"Error retrieving appointment data for {location}: {e}")
 
-if "data" in st.session_state:
-    df = st.session_state["data"]
-    duration = st.number_input("Appointment Duration (minutes)", min_value=1, max_value=540, value=60)
-
-    if st.button("📅 Show Top 3 Optimal Chair/Days"):
-        results = find_top3_optimal_chairs(df, location, duration)
-        if not results.empty:
-            st.subheader(f"Next 3 Optimal Chair Appointment Days — {location} (Starting Tomorrow)")
-            st.dataframe(results, use_container_width=True)
+if "util" in st.session_state:
+    optimizer_panel(location)
 else:
     st.info("Select a location and click **Load Schedule** to begin.")
 